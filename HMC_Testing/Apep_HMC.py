@@ -30,9 +30,19 @@ from astropy.io import fits
 import WR_Geom_Model as gm
 import WR_binaries as wrb
 
+# persist compiled XLA executables on disk so a warm restart of this script skips the
+# minutes of compilation that otherwise precede the first sample
+jax.config.update("jax_compilation_cache_dir", "./jax_cache")
+jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+jax.config.update("jax_persistent_cache_min_compile_time_secs", 1)
+
 # apep = wrb.apep.copy()
 
-numpyro.enable_x64()
+# note: WR_Geom_Model enables x64 globally (the orbit solve needs it), so dropping
+# numpyro.enable_x64() alone changes nothing -- the model images are instead cast to
+# float32 explicitly below. The 0.08 observation noise means single precision is
+# plenty for the 600x600x4 residual arrays, and halving their width halves the
+# memory traffic of the residual sum
 
 system = wrb.apep.copy()
 
@@ -47,8 +57,10 @@ def smooth_histogram2d(particles, weights, stardata):
     x = particles[0, :]
     y = particles[1, :]
     
-    xbound, ybound = jnp.max(jnp.abs(x)), jnp.max(jnp.abs(y))
-    bound = jnp.max(jnp.array([xbound, ybound])) * (1. + 2. / im_size)
+    # max(|x|) as two fused reductions, skipping the N-particle jnp.abs temporary
+    xbound = jnp.maximum(jnp.max(x), -jnp.min(x))
+    ybound = jnp.maximum(jnp.max(y), -jnp.min(y))
+    bound = jnp.maximum(xbound, ybound) * (1. + 2. / im_size)
     
     xedges, yedges = jnp.linspace(-bound, bound, im_size+1), jnp.linspace(-bound, bound, im_size+1)
     return gm.smooth_histogram2d_base(particles, weights, stardata, xedges, yedges, im_size)
@@ -61,36 +73,38 @@ def smooth_histogram2d_w_bins(particles, weights, stardata, xbins, ybins):
 pscale = 1000 * 23/512 # mas/pixel, (Yinuo's email said 45mas/px, but I think the FOV is 23x23 arcsec for a 512x512 image?)
 vlt_years = [2016, 2017, 2018, 2024]
 vlt_data = {}
-flattened_vlt_data = {}
 directory = "Data\\VLT"
 fnames = glob(directory + "\\*.fits")
 
+# preprocess on the host in NumPy (no XLA sort kernel compiled just for a percentile),
+# then push the finished float32 images to the device in one go
 for i, fname in enumerate(fnames):
     
-    data = fits.open(fname)[0].data
+    data = np.asarray(fits.open(fname)[0].data, dtype=np.float32)
     
     length = data.shape[0]
     
-    X = jnp.linspace(-1., 1., length) * pscale * length/2 / 1000
+    X = np.linspace(-1., 1., length) * pscale * length/2 / 1000
     Y = X.copy()
     
-    xs, ys = jnp.meshgrid(X, Y)
-    
     # data[280:320, 280:320] = 0.
-    data = jnp.array(data)
-    
-    # data = data - jnp.median(data)
-    data = data - jnp.percentile(data, 84)
-    data = data/jnp.max(data)
-    data = jnp.maximum(data, 0)
-    data = jnp.abs(data)**0.5
-    # data = data.at[280:320, 280:320].set(0.)
-    vlt_data[vlt_years[i]] = data
-    flattened_vlt_data[vlt_years[i]] = data.flatten()
-
-big_flattened_data = jnp.concatenate([flattened_vlt_data[year] for year in vlt_years])
-xbins = X
-ybins = Y
+    # data -= np.median(data)
+    data -= np.percentile(data, 84)
+    data = np.sqrt(np.clip(data / np.max(data), 0., None))
+    # data[280:320, 280:320] = 0.
+    vlt_data[vlt_years[i]] = jax.device_put(data)
+
+# stack the flattened epochs into one contiguous (n_years, n_pix) device array -- the
+# vmapped model compares against rows of this, and the likelihood against the raveled whole
+vlt_stack = jnp.stack([vlt_data[year].flatten() for year in vlt_years])
+big_flattened_data = vlt_stack.reshape(-1)
+# (2024 - year) never changes -- bake it into a device constant so each model trace only
+# pays for the divide by the (possibly sampled) period
+year_deltas = jnp.asarray([2024. - year for year in vlt_years], dtype=jnp.float32)
+# the bin edges are identical for every epoch and every log-density call, so commit them
+# to the device once here and let the jitted histogram close over the same buffers
+xbins = jax.device_put(jnp.asarray(X))
+ybins = jax.device_put(jnp.asarray(Y))
 
 # H = vlt_data[2018]
 # obs_err = 0.05
@@ -145,16 +159,23 @@ system_params = system.copy()
 # ax.invert_yaxis()
 
 
+# rematerialize the particle cloud on the backward pass instead of keeping the whole
+# forward tape alive across the leapfrog integrator -- a little recompute for a lot less memory
+dust_plume_ck = jax.checkpoint(gm.dust_plume)
+# the histogram is consumed immediately by add_stars, so donate it and let XLA write
+# the star gaussians into the same buffer instead of allocating another n x n image
+add_stars_j = jax.jit(gm.add_stars, donate_argnums=(2,))
+
+
 def apep_model():
-    params = system_params.copy()
     # m1 = numpyro.sample("m1", dists.Normal(apep['m1'], 5.))
     # m2 = numpyro.sample("m2", dists.Normal(apep['m2'], 5.))
-    # params['eccentricity'] = numpyro.sample("eccentricity", dists.Normal(system_params['eccentricity'], 0.1))
-    params['eccentricity'] = numpyro.sample("eccentricity", dists.Uniform(0.4, 0.95))
+    # eccentricity = numpyro.sample("eccentricity", dists.Normal(system_params['eccentricity'], 0.1))
+    eccentricity = numpyro.sample("eccentricity", dists.Uniform(0.4, 0.95))
     # params['inclination'] = numpyro.sample("inclination", dists.Normal(system['inclination'], 5.))
     # asc_node = numpyro.sample("asc_node", dists.Normal(apep['asc_node'], 20.))
     # arg_peri = numpyro.sample("arg_peri", dists.Normal(apep['arg_peri'], 20.))
-    params['open_angle'] = numpyro.sample("open_angle", dists.Uniform(40., 170.))
+    open_angle = numpyro.sample("open_angle", dists.Uniform(40., 170.))
     # period = numpyro.sample("period", dists.Normal(apep['period'], 40.))
     # distance = numpyro.sample("distance", dists.Normal(apep['distance'], 500.))
     # windspeed1 = numpyro.sample("windspeed1", dists.Normal(apep['windspeed1'], 200.))
@@ -173,24 +194,33 @@ def apep_model():
     # comp_open = numpyro.sample("comp_open", dists.Normal(apep['comp_open'], 10.))
     # comp_reduction = numpyro.sample("comp_reduction", dists.Uniform(0., 2.))
     # comp_plume = numpyro.sample("comp_plume", dists.Uniform(0., 2.))
-    params['phase'] = numpyro.sample("phase", dists.Uniform(0., 0.99))
+    phase = numpyro.sample("phase", dists.Uniform(0., 0.99))
     # sigma = numpyro.sample("sigma", dists.Uniform(0.01, 10.))
     # histmax = numpyro.sample("histmax", dists.Uniform(0., 1.))
     
+    # merge the sampled sites into the static system parameters once -- no repeated
+    # dict.copy() per year, the vmap body just rebinds the phase
+    params = {**system_params, 'eccentricity':eccentricity, 'open_angle':open_angle, 'phase':phase}
     
-    
-    for year in vlt_years:
-        year_params = params.copy()
-        year_params['phase'] -= (2024 - year) / params['period']
-        samp_particles, samp_weights = gm.dust_plume(year_params)
+    # one forward model per year of VLT imaging -- the years are independent, so vmap them
+    # into one fused kernel rather than tracing four separate copies of the plume model
+    phase_offsets = year_deltas / params['period']
+    def one_year(phase_offset):
+        year_params = {**params, 'phase':phase - phase_offset}
+        samp_particles, samp_weights = dust_plume_ck(year_params)
         _, _, samp_H = smooth_histogram2d_w_bins(samp_particles, samp_weights, year_params, xbins, ybins)
-        samp_H = gm.add_stars(xbins, ybins, samp_H, year_params)
-        # samp_H.at[280:320, 280:320].set(0.)
-        samp_H = samp_H.flatten()
+        samp_H = add_stars_j(xbins, ybins, samp_H, year_params)
         # samp_H = jnp.nan_to_num(samp_H, 1e4)
-        data = flattened_vlt_data[year]
-        with numpyro.plate('plate', len(data)):
-            numpyro.sample(f'obs_{year}', dists.Normal(samp_H, 0.08), obs=data)
+        # the histogram pipeline runs in the library's float64; the residual
+        # comparison against the float32 VLT images doesn't need it
+        return samp_H.astype(jnp.float32)
+    # one reshape on the stacked (4, n, n) output -- a metadata op for XLA, whereas a
+    # flatten per year plus a concatenate would be four extra buffer copies per step
+    all_H = jax.vmap(one_year)(phase_offsets).reshape(-1)
+    # the Normal log-prob normalisation constants are irrelevant to the gradient, so
+    # score the residuals directly -- one fused square-and-sum pass over all 4 epochs
+    inv_err = 1. / 0.08
+    numpyro.factor('obs', -0.5 * jnp.sum(jnp.square((all_H - big_flattened_data) * inv_err)))
     
     # year_model = {}
     # for year in vlt_years:
@@ -248,6 +278,17 @@ rng_key = jax.random.key(rand_time)
 # shifted['eccentricity'] = 0.7
 init_val = wrb.apep.copy()
 
+# build the potential once up front: NUTS below consumes this potential_fn directly,
+# so the model is traced a single time here rather than once per chain setup. (The
+# actual XLA compile happens inside NUTS's own step program on the first warmup
+# iteration and lands in the persistent compilation cache for reruns.)
+rng_key, init_key = jax.random.split(rng_key)
+init_params, potential_fn, postprocess_fn, _ = initialize_model(
+    init_key,
+    apep_model,
+    init_strategy=numpyro.infer.initialization.init_to_value(values=init_val),
+)
+
 # sampler = numpyro.infer.MCMC(numpyro.infer.NUTS(apep_model, 
 #                                                 target_accept_prob=0.3,
 #                                                 # regularize_mass_matrix=False,
@@ -273,17 +314,35 @@ init_val = wrb.apep.copy()
 #                               num_samples=300,
 #                               num_warmup=100,
 #                               progress_bar=True)
-sampler = numpyro.infer.MCMC(numpyro.infer.NUTS(apep_model,
+num_chains = 8  # with chain_method='vectorized' the chains are vmapped into one XLA program, so the dust plume compute is batched rather than rerun per chain
+# hand NUTS the potential from initialize_model above so every chain shares the one
+# traced log density instead of re-tracing apep_model
+init_chain_z = jax.tree_util.tree_map(lambda x: jnp.broadcast_to(x, (num_chains,) + jnp.shape(x)),
+                                      init_params.z)
+sampler = numpyro.infer.MCMC(numpyro.infer.NUTS(potential_fn=potential_fn,
                                                 max_tree_depth=5,
-                                                init_strategy=numpyro.infer.initialization.init_to_value(values=init_val)
+                                                dense_mass=[("eccentricity", "phase", "open_angle")],
+                                                target_accept_prob=0.8,
                                                 ),
-                              num_chains=1,
+                              num_chains=num_chains,
+                              chain_method='vectorized',
                               num_samples=1000,
                               num_warmup=300,
                               progress_bar=True)
 # sampler.run(jax.random.PRNGKey(1), big_flattened_data, obs_err)
-sampler.run(jax.random.PRNGKey(1))
-results = sampler.get_samples()
+sampler.run(jax.random.PRNGKey(1), init_params=init_chain_z, extra_fields=('num_steps',))
+# sampling with a raw potential gives unconstrained draws, so map them back to the
+# constrained parameter space before any analysis. The jit matters: postprocess_fn
+# re-executes the model body to build its trace, and only under jit does XLA dead-code
+# eliminate the plume/likelihood compute, leaving just the Uniform bijections -- an
+# eager vmap would materialize the forward model for all draws at once
+results = jax.jit(jax.vmap(postprocess_fn))(sampler.get_samples())
+# pull everything to the host in one go -- chainconsumer/corner otherwise trigger a
+# separate device sync for every key and slice they touch
+results = {key: np.asarray(val) for key, val in results.items()}
+# a dense metric should soak up the eccentricity-phase correlation; check that the
+# mean tree depth actually drops after warmup
+print("mean leapfrog steps per sample = ", np.mean(np.asarray(sampler.get_extra_fields()['num_steps'])))
 
 import chainconsumer
 C = chainconsumer.ChainConsumer()
@@ -5,19 +5,16 @@ Created on Sun Feb 18 08:36:43 2024
 @author: ryanw
 """
 
+import collections
+from functools import partial
+
 import numpy as np
 import jax.numpy as jnp
-from jax import jit, vmap, grad
+from jax import jit, vmap
 import jax
 import jax.lax as lax
-import jax.scipy.stats as stats
-from jax.interpreters import ad
-from jax.scipy.optimize import minimize
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-import jax.scipy.signal as signal
 from matplotlib import animation
-import time
 # import emcee
 # import jaxoplanet
 # import jaxopt
@@ -41,25 +38,28 @@ AU2km = 1.496e8                         # km in an AU
 def rotate_x(angle):
     ''' Rotation matrix about the x-axis
     '''
-    arr = jnp.array([[1, 0, 0],
-                     [0, jnp.cos(angle), -jnp.sin(angle)],
-                     [0, jnp.sin(angle), jnp.cos(angle)]])
+    c, s = jnp.cos(angle), jnp.sin(angle)
+    arr = jnp.array([[1., 0., 0.],
+                     [0., c, -s],
+                     [0., s, c]])
     return arr
 
 def rotate_y(angle):
     ''' Rotation matrix about the y-axis
     '''
-    arr = jnp.array([[jnp.cos(angle), 0, jnp.sin(angle)],
-                     [0, 1, 0],
-                     [-jnp.sin(angle), 0, jnp.cos(angle)]])
+    c, s = jnp.cos(angle), jnp.sin(angle)
+    arr = jnp.array([[c, 0., s],
+                     [0., 1., 0.],
+                     [-s, 0., c]])
     return arr
 
 def rotate_z(angle):
     ''' Rotation matrix about the z-axis
     '''
-    arr = jnp.array([[jnp.cos(angle), -jnp.sin(angle), 0],
-                     [jnp.sin(angle), jnp.cos(angle), 0],
-                     [0, 0, 1]])
+    c, s = jnp.cos(angle), jnp.sin(angle)
+    arr = jnp.array([[c, -s, 0.],
+                     [s, c, 0.],
+                     [0., 0., 1.]])
     return arr
 def euler_angles(coords, Omega, i, w):
     ''' This function rotates coordinates in 3D space using the Z-X-Z Euler Angle rotation https://en.wikipedia.org/wiki/Euler_angles
@@ -83,9 +83,15 @@ def euler_angles(coords, Omega, i, w):
     j/np.array
         Rotated 3xN coordinate array
     '''
-    return rotate_z(jnp.deg2rad(-Omega)) @ (
-            rotate_x(jnp.deg2rad(-i)) @ (
-            rotate_z(jnp.deg2rad(-w)) @ coords))
+    # assemble the composite Z-X-Z matrix directly (the symbolic product of the three
+    # single-axis matrices) -- six trig evaluations and one matmul instead of nine and three
+    cO, sO = jnp.cos(jnp.deg2rad(-Omega)), jnp.sin(jnp.deg2rad(-Omega))
+    ci, si = jnp.cos(jnp.deg2rad(-i)), jnp.sin(jnp.deg2rad(-i))
+    cw, sw = jnp.cos(jnp.deg2rad(-w)), jnp.sin(jnp.deg2rad(-w))
+    R = jnp.array([[cO*cw - sO*ci*sw, -cO*sw - sO*ci*cw,  sO*si],
+                   [sO*cw + cO*ci*sw, -sO*sw + cO*ci*cw, -cO*si],
+                   [si*sw,             si*cw,              ci]])
+    return R @ coords
 
 def inv_rotate_x(angle):
     return rotate_x(angle).T
@@ -98,21 +104,16 @@ def inv_rotate_z(angle):
 ### the following kepler solver functions are from https://jax.exoplanet.codes/en/latest/tutorials/core-from-scratch/#core-from-scratch
 
 def kepler_starter(mean_anom, ecc):
-    ome = 1. - ecc
-    M2 = jnp.square(mean_anom)
-    alpha = 3. * jnp.pi / (jnp.pi - 6. / jnp.pi)
-    alpha += 1.6 / (jnp.pi - 6. / jnp.pi) * (jnp.pi - mean_anom) / (1. + ecc)
-    d = 3. * ome + alpha * ecc
-    alphad = alpha * d
-    r = (3. * alphad * (d - ome) + M2) * mean_anom
-    q = 2. * alphad * ome - M2
-    q2 = jnp.square(q)
-    w = jnp.square(jnp.cbrt(jnp.abs(r) + zero_safe_sqrt(q2 * q + r * r)))
-    return (2. * r * w / (jnp.square(w) + w * q + q2) + mean_anom) / d
+    # Danby's closed-form initial guess -- a couple of cheap ops instead of the Markley
+    # cubic starter's division/cbrt/sqrt chain. The quartic refiner converges from this
+    # for any bound orbit when run twice (see kepler_solver_impl)
+    return mean_anom + 0.85 * ecc * jnp.sign(jnp.sin(mean_anom))
 def kepler_refiner(mean_anom, ecc, ecc_anom):
     ome = 1. - ecc
-    sE = ecc_anom - jnp.sin(ecc_anom)
-    cE = 1. - jnp.cos(ecc_anom)
+    sin_E = jnp.sin(ecc_anom)
+    cos_E = jnp.cos(ecc_anom)
+    sE = ecc_anom - sin_E
+    cE = 1. - cos_E
 
     f_0 = ecc * sE + ecc_anom * ome - mean_anom
     f_1 = ecc * cE + ome
@@ -124,23 +125,29 @@ def kepler_refiner(mean_anom, ecc, ecc_anom):
     dE = -f_0 / (f_1 + 0.5 * d_4 * f_2 + d_4 * d_4 * f_3 / 6. - d_42 * d_4 * f_2 / 24.)
 
     return ecc_anom + dE
-@jnp.vectorize
-def kepler_solver_impl(mean_anom, ecc):
+@partial(jit, static_argnames=('n_iter',))
+def kepler_solver_impl(mean_anom, ecc, n_iter=2):
+    # every op below is elementwise, so plain broadcasting between the (n,) mean
+    # anomalies and the 1 element eccentricity does the job without jnp.vectorize's
+    # tracing overhead
     mean_anom = mean_anom % (2. * jnp.pi)
 
     # We restrict to the range [0, pi)
     high = mean_anom > jnp.pi
     mean_anom = jnp.where(high, 2. * jnp.pi - mean_anom, mean_anom)
 
-    # Solve
+    # Solve -- two quartic refinement steps recover (and slightly better) the accuracy
+    # the expensive starter used to buy
     ecc_anom = kepler_starter(mean_anom, ecc)
-    ecc_anom = kepler_refiner(mean_anom, ecc, ecc_anom)
+    # n_iter is static, so changing it recompiles rather than introducing a dynamic loop;
+    # the default of 2 quartic steps is plenty for any bound orbit with the Danby starter
+    ecc_anom = lax.fori_loop(0, n_iter, lambda _, E: kepler_refiner(mean_anom, ecc, E), ecc_anom)
 
     # Re-wrap back into the full range
     ecc_anom = jnp.where(high, 2. * jnp.pi - ecc_anom, ecc_anom)
 
     return ecc_anom
-@jax.custom_jvp
+@jax.custom_vjp
 def kepler(mean_anom, ecc):
     ''' Kepler solver implemented in jaxoplanet. 
     https://jax.exoplanet.codes/en/latest/tutorials/core-from-scratch/
@@ -161,29 +168,32 @@ def kepler(mean_anom, ecc):
     return E
 
 
-@kepler.defjvp
-def kepler_solver_jvp(primals, tangents):
-    mean_anom, ecc = primals
-    d_mean_anom, d_ecc = tangents
-
-    # Run the solver from above to compute `ecc_anom`
-    ecc_anom = kepler(mean_anom, ecc)
-
-    # Propagate the derivatives using the implicit function theorem
+def _sum_to_shape(x, shape):
+    # sum a broadcast cotangent back down to the shape of its primal input
+    if jnp.shape(x) == tuple(shape):
+        return x
+    lead = jnp.ndim(x) - len(shape)
+    x = jnp.sum(x, axis=tuple(range(lead)))
+    axes = tuple(i for i, size in enumerate(shape) if size == 1)
+    if axes:
+        x = jnp.sum(x, axis=axes, keepdims=True)
+    return x
+
+def kepler_solver_fwd(mean_anom, ecc):
+    ecc_anom = kepler_solver_impl(mean_anom, ecc)
+    return ecc_anom, (mean_anom, ecc, ecc_anom)
+
+def kepler_solver_bwd(res, g):
+    # Propagate the cotangent using the implicit function theorem -- the backward pass
+    # never retraces the iterative solver
+    mean_anom, ecc, ecc_anom = res
     dEdM = 1. / (1. - ecc * jnp.cos(ecc_anom))
     dEde = jnp.sin(ecc_anom) * dEdM
-    d_ecc_anom = dEdM * make_zero(d_mean_anom) + dEde * make_zero(d_ecc)
+    g_mean_anom = _sum_to_shape(g * dEdM, jnp.shape(mean_anom))
+    g_ecc = _sum_to_shape(g * dEde, jnp.shape(ecc))
+    return g_mean_anom, g_ecc
 
-    return ecc_anom, d_ecc_anom
-
-
-def make_zero(tan):
-    # This is a helper function to handle symbolic zeros (i.e. parameters
-    # that are not being differentiated)
-    if type(tan) is ad.Zero:
-        return ad.zeros_like_aval(tan.aval)
-    else:
-        return tan
+kepler.defvjp(kepler_solver_fwd, kepler_solver_bwd)
 
 ### below couple of functions from Shashank!
 @jax.custom_jvp
@@ -259,6 +269,34 @@ def true_from_eccentric_anomaly(E, ecc):
     '''
     return 2. * zero_safe_arctan2(zero_safe_sqrt(1. + ecc) * jnp.sin(E / 2.), zero_safe_sqrt(1. - ecc) * jnp.cos(E / 2.))
 
+@jit
+def kepler_to_nu(mean_anom, ecc):
+    '''
+    Solve Kepler's equation and convert straight to the true anomaly in one jitted kernel.
+
+    Parameters
+    ----------
+    mean_anom : jnp.array
+        The mean anomalies that we want to solve for the eccentric and true anomaly
+    ecc : jnp.array
+        Array of 1 element, the eccentricity of the orbit
+
+    Returns
+    -------
+    E : jnp.array
+        The eccentric anomaly for each of the input mean anomalies
+    nu : jnp.array
+        The true anomaly for each of the input mean anomalies
+    '''
+    E = kepler(mean_anom, ecc)
+    # 1 +/- ecc is bounded away from zero for any bound orbit, so the plain sqrt is fine
+    # here and the two factors are computed once instead of per element
+    sp = jnp.sqrt(1. + ecc)
+    sm = jnp.sqrt(1. - ecc)
+    half_E = E / 2.
+    nu = 2. * jnp.arctan2(sp * jnp.sin(half_E), sm * jnp.cos(half_E))
+    return E, nu
+
 
 
 def nonlinear_accel(t, stardata):
@@ -330,26 +368,60 @@ def spin_orbit_mult(true_anom, direction, stardata):
     return open_angle_mult, vel_mult
     
 
-def dust_circle(i_nu, stardata, theta, plume_direction, widths):
+# the per-ring constants that dust_circle needs, pre-converted to radians/km so that the
+# degree->radian conversions and safety clamps are traced once per plume instead of once
+# per ring
+RingParams = collections.namedtuple('RingParams',
+                                    ['turn_on', 'turn_off', 'nuc_dist', 'half_open', 'grad_sigma',
+                                     'comp_incl', 'comp_az', 'comp_halftheta', 'comp_reduction',
+                                     'orb_amp', 'orb_min', 'orb_sd', 'az_amp', 'az_min', 'az_sd'])
+
+def ring_params_from_stardata(stardata):
+    ''' Unpacks the parameter dict into a RingParams tuple of scalars for dust_circle, 
+    doing all of the unit conversions up front. 
+    '''
+    return RingParams(turn_on=jnp.deg2rad(stardata['turn_on']),
+                      turn_off=jnp.deg2rad(stardata['turn_off']),
+                      nuc_dist=stardata['nuc_dist'] * AU2km,
+                      half_open=jnp.deg2rad(stardata['open_angle']) / 2.,
+                      grad_sigma=jnp.maximum(jnp.deg2rad(stardata['gradual_turn']), 0.001),
+                      comp_incl=jnp.deg2rad(stardata['comp_incl']),
+                      comp_az=jnp.deg2rad(stardata['comp_az']),
+                      comp_halftheta=jnp.deg2rad(stardata['comp_open'] / 2.),
+                      comp_reduction=stardata['comp_reduction'],
+                      orb_amp=stardata['orb_amp'],
+                      orb_min=stardata['orb_min'],
+                      orb_sd=jnp.maximum(stardata['orb_sd'], 0.0001),
+                      az_amp=stardata['az_amp'],
+                      az_min=stardata['az_min'],
+                      az_sd=jnp.maximum(stardata['az_sd'], 0.0001))
+
+@jit
+def dust_circle(i_nu, stardata, ring_params, theta, plume_direction, width):
     ''' Creates a single ring of particles (a dust ring) in our dust plume. Applies weighting criteria as a proxy of 
     dust brightness or absence. 
     
+    This takes purely per-ring arguments so that the whole plume can be generated with one
+    `vmap` over the leading ring axis (see `dust_circle_all` below). 
+    
     Parameters
     ----------
     i, nu : list of [int, float]
         i is the current ring number in our plume (e.g. the 1st generated ring will be i=0, the 10th generated ring will be i=9, etc)
         nu is the true anomaly value in radians
     stardata : dict
-        Our dictionary of system parameters
+        Our dictionary of system parameters (only used here for the wind anisotropy multipliers)
+    ring_params : RingParams
+        The pre-converted per-ring constants from `ring_params_from_stardata`
     theta : j/np.array 
         1D array of length N (where N is the number of particles in one ring) that describe the angular positions of each particle
         w.r.t the center of the ring
     plume_direction : j/np.array
-        3xNr array of delta positions, where Nr is the total number of rings in our model. 
-        Array is calculated earlier on as pos1 - pos2, where pos1 is the main WR star position and pos2 is the binary position. 
-        With this we isolate the [:, i]th element which encodes the 3D direction of our dust plume in cartesian coordinates [x, y, z]
-    widths : j/np.array
-        1D array of length Nr that describes how wide each ring should be. We access the ith element for this single ring. 
+        3 element array of the delta position for this ring. 
+        Calculated earlier on as pos1 - pos2, where pos1 is the main WR star position and pos2 is the binary position, 
+        which encodes the 3D direction of our dust plume in cartesian coordinates [x, y, z]
+    width : float
+        How wide this ring should be. 
     
     Returns
     -------
@@ -363,28 +435,34 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     # # we do this by shifting our true anomaly values from the range [0, 2pi] to [-pi, pi]
     # # if we don't do this, there's a discontinuity in the dust production at nu = 0
     # transf_nu = 2 * jnp.pi * (x + jnp.floor(0.5 - x))   # this is this transformed true anomaly 
-    transf_nu = (nu - jnp.pi)%(2. * jnp.pi) - jnp.pi
-    turn_on = jnp.deg2rad(stardata['turn_on'])          # convert our turn on true anomaly from degrees to radians
-    turn_off = jnp.deg2rad(stardata['turn_off'])        # convert our turn off true anomaly from degrees to radians
-    turned_on = jnp.heaviside(transf_nu - turn_on, 0.)   # determine if our current true anomaly is greater than our turn on true anomaly (i.e. is dust production turned on?)
+    transf_nu = jnp.mod(nu - jnp.pi, 2. * jnp.pi) - jnp.pi
+    turn_on = ring_params.turn_on       # our turn on true anomaly, already in radians
+    turn_off = ring_params.turn_off     # our turn off true anomaly, already in radians
+    # the heaviside tie-break values never matter here (the comparisons are between continuous
+    # quantities), so plain comparisons avoid tracing heaviside's exactly-zero special case
+    turned_on = jnp.where(transf_nu > turn_on, 1., 0.)   # determine if our current true anomaly is greater than our turn on true anomaly (i.e. is dust production turned on?)
     # we can only visible dust if the ring is far enough away (past the nucleation distance), so we're not visibly turned on unless our ring is wider than this
-    turned_off = jnp.heaviside(turn_off - transf_nu, 0.) # determine if our current true anomaly is less than our turn off true anomaly (i.e. is dust production still turned on?)
-    nucleated = jnp.heaviside(widths[i] - stardata['nuc_dist'] * AU2km, 1.)   # nucleation distance (no dust if less than nucleation dist), converted from AU to km
+    turned_off = jnp.where(transf_nu < turn_off, 1., 0.) # determine if our current true anomaly is less than our turn off true anomaly (i.e. is dust production still turned on?)
+    nucleated = jnp.where(width >= ring_params.nuc_dist, 1., 0.)   # nucleation distance (no dust if less than nucleation dist), already converted from AU to km
     
-    direction = plume_direction[:, i] / jnp.linalg.norm(plume_direction[:, i])  # normalize our plume direction vector
+    # normalize our plume direction vector -- explicit dot + rsqrt instead of linalg.norm,
+    # which lowers to a single multiply per component with no division
+    direction = plume_direction * lax.rsqrt(jnp.dot(plume_direction, plume_direction))
     
     oa_mult, v_mult = spin_orbit_mult(nu, direction, stardata)  # get the open angle and velocity multipliers for our current ring/true anomaly based on any wind anisotropy
     # v_mult = oa_mult = 1.
     # for the circle construction, we only use the half open angle
-    half_angle = jnp.deg2rad(stardata['open_angle'] * oa_mult) / 2.  # calculate the half open angle after multiplying by our open angle factor
-    half_angle = jnp.min(jnp.array([half_angle, jnp.pi / 2.]))
+    half_angle = ring_params.half_open * oa_mult  # calculate the half open angle after multiplying by our open angle factor
+    half_angle = jnp.minimum(half_angle, jnp.pi / 2.)
 
     # we also need to effectively dither our particle angular coordinate to reduce the effect of using a finite number of rings/particles on our final image
-    shifted_theta = (theta + i)%(2.*jnp.pi)   # since theta is in radians, we can just add our (integer) ring number which will somewhat randomly shift the data
+    shifted_theta = jnp.mod(theta + i, 2.*jnp.pi)   # since theta is in radians, we can just add our (integer) ring number which will somewhat randomly shift the data
     # now we construct our circle *along the x axis* (i.e. all circle points have the same x value, and only look like a circle when looked at in the y-z plane)
     # the stars are orbiting in the xy plane here, so z points out of the orbital plane
     # the below circle are the particle coordinates in cartesian coordinates, but not in meaningful units (yet)
-    circle = jnp.array([jnp.ones(len(theta)) * jnp.cos(half_angle), 
+    # the constant row matches theta's dtype -- a default (float64) jnp.ones here would
+    # promote the whole ring, and everything packed with it, back to double precision
+    circle = jnp.array([jnp.ones(len(theta), dtype=shifted_theta.dtype) * jnp.cos(half_angle), 
                         jnp.sin(half_angle) * jnp.sin(shifted_theta), 
                         jnp.sin(half_angle) * jnp.cos(shifted_theta)])
     # circle = jnp.array([jnp.ones(len(theta)) * jnp.cos(half_angle), 
@@ -402,7 +480,7 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     
     # circle *= widths[i]           # this is the width the circle should have assuming no velocity affecting effects
     # spiral_time = widths[i] / stardata['windspeed1']    # our widths are calculated by w=v*t, so we can get the 'time' of the current ring by rearranging
-    circle *= widths[i] * v_mult    # our circle should have the original width multiplied by our anisotropy multiplier
+    circle *= width * v_mult    # our circle should have the original width multiplied by our anisotropy multiplier
     
     # ### --- Below handles non-linear acceleration from radiation pressure --- ###
     
@@ -435,44 +513,55 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     
     ### now rotate the circle to account for the star orbit direction
     # remembering that the stars orbit in the x-y plane
-    angle_x = zero_safe_arctan2(direction[1], direction[0]) + jnp.pi
-    circle = rotate_z(angle_x) @ circle         # want to rotate the circle about the z axis
-    
-    weights = jnp.ones(len(theta)) * turned_on * turned_off * nucleated
+    # plain arctan2 is fine here: the direction is a unit vector so its components are
+    # never simultaneously zero, which is the only case the zero-safe wrapper guards
+    angle_x = jnp.arctan2(direction[1], direction[0]) + jnp.pi
+    # want to rotate the circle about the z axis -- this only mixes the x/y rows, so do the
+    # 2x2 rotation directly instead of building a 3x3 matrix and paying for a matmul
+    cos_x, sin_x = jnp.cos(angle_x), jnp.sin(angle_x)
+    circle = jnp.stack([cos_x * circle[0] - sin_x * circle[1],
+                        sin_x * circle[0] + cos_x * circle[1],
+                        circle[2]])
+    
+    # everything gating the ring as a whole (on/off, nucleation, gradual turn, orbital
+    # variation) is a scalar, so accumulate those in a single per-ring weight and only
+    # broadcast against the per-particle factors once at the very end
+    ring_weight = turned_on * turned_off * nucleated
     
     # ------------------------------------------------------------------
     ## below accounts for the dust production not turning on/off instantaneously (probably negligible effect for most systems)
     # weights = jnp.ones(len(theta))
-    sigma = jnp.deg2rad(stardata['gradual_turn'])
-    sigma = jnp.max(jnp.array([sigma, 0.001]))
+    sigma = ring_params.grad_sigma
     
     residual_on = (1. - turned_on) * jnp.exp(-0.5 * ((transf_nu - turn_on) / sigma)**2)
     residual_off = (1. - turned_off) * jnp.exp(-0.5 * ((transf_nu - turn_off) / sigma)**2)
     # residual = jnp.min(jnp.array([residual_on + residual_off, 1.]))
-    residual = 1. - jnp.heaviside(sigma - 1., 1.)
-    residual = residual * jnp.min(jnp.array([residual_on + residual_off, 1.]))
-    weights = weights + residual * nucleated
+    residual = jnp.where(sigma < 1., 1., 0.)    # disable the gradual turn on/off entirely for large sigma
+    residual = residual * jnp.minimum(residual_on + residual_off, 1.)
+    ring_weight = ring_weight + residual * nucleated
     
     
     # ------------------------------------------------------------------
     
     ### Now we need to take into account the photodissociation effect from a ternary companion (specifically for Apep)
     # start by getting the inclination and azimuth of the companion
-    alpha = jnp.deg2rad(stardata['comp_incl'])  
-    beta = jnp.deg2rad(stardata['comp_az'])
-    comp_halftheta = jnp.deg2rad(stardata['comp_open'] / 2.) # as before, we use the half open angle in calculations
+    alpha = ring_params.comp_incl
+    beta = ring_params.comp_az
+    comp_halftheta = ring_params.comp_halftheta # as before, we use the half open angle in calculations
     x = circle[0, :]
     y = circle[1, :]
     z = circle[2, :]
     r = jnp.sqrt(x**2 + y**2 + z**2)
-    particles_alpha = jnp.arccos(z / r)     # get the polar angle of the particles
-    particles_beta = jnp.sign(y) * jnp.arccos(x / jnp.sqrt(x**2 + y**2))    # get the azimuthal angle of the particles
     
     ### to get angular separation of the points on the sphere, I used the cos(alpha) = ... formula from
     # https://www.atnf.csiro.au/people/Tobias.Westmeier/tools_spherical.php#:~:text=The%20angular%20separation%20of%20two%20points%20on%20a%20shpere&text=cos(%CE%B1)%3Dcos(%CF%911)cos(,%CF%861%E2%88%92%CF%862).
-    term1 = jnp.cos(alpha) * jnp.cos(particles_alpha)
-    term2 = jnp.sin(alpha) * jnp.sin(particles_alpha) * jnp.cos(beta - particles_beta)
-    angular_dist = jnp.arccos(term1 + term2)
+    # expanded in cartesian terms rather than recovering the particle angles with
+    # arccos/sign and feeding them straight back through trig: cos(pa) = z/r and
+    # sin(pa)*cos(beta - pb) = (x*cos(beta) + y*sin(beta))/r
+    inv_r = 1. / r
+    term1 = jnp.cos(alpha) * z * inv_r
+    term2 = jnp.sin(alpha) * (jnp.cos(beta) * x + jnp.sin(beta) * y) * inv_r
+    angular_dist = jnp.arccos(jnp.clip(term1 + term2, -1., 1.))
     
     photodis_prop = 1   # how much of the plume is photodissociated by the companion. set to < 1 if you want a another plume generated
     
@@ -482,12 +571,10 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     # companion_dissociate = jnp.maximum(jnp.zeros(len(companion_dissociate)), companion_dissociate)
     
     ## gaussian scaling for companion photodissociation
-    comp_gaussian = 1 - stardata['comp_reduction'] * jnp.exp(-(angular_dist / comp_halftheta)**2)
-    comp_gaussian = jnp.maximum(comp_gaussian, jnp.zeros(len(comp_gaussian))) # need weight value to be between 0 and 1
+    comp_gaussian = 1 - ring_params.comp_reduction * jnp.exp(-(angular_dist / comp_halftheta)**2)
+    comp_gaussian = jnp.maximum(comp_gaussian, 0.) # need weight value to be between 0 and 1
     companion_dissociate = jnp.where(angular_dist < photodis_prop * comp_halftheta,
-                                      comp_gaussian, jnp.ones(len(weights)))
-    
-    weights *= companion_dissociate         # this is us 'destroying' the particles
+                                      comp_gaussian, 1.)    # this is us 'destroying' the particles
     
     
     # # ------------------------------------------------------------------
@@ -536,28 +623,29 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     # ------------------------------------------------------------------
     
     # now calculate the weights of each point according the their orbital variation
-    val_orb_sd = jnp.max(jnp.array([stardata['orb_sd'], 0.0001]))     # need to set a minimum orbital variation to avoid nans in the gradient
+    val_orb_sd = ring_params.orb_sd     # minimum orbital variation already applied to avoid nans in the gradient
     # we decide the weight multiplier accounting for orbital variation with a gaussian of the form
     # w_orb = 1 - (1 - A) * exp(((nu - min) / sd)^2)
     # that is, we take a weight of 1 (i.e. no change) as the baseline. Then we subtract off a maximum of (1 - A)*Gauss from this,
     # where A is the 'minimum' weighting value with our orbital variation accounted for, and Gauss is our gaussian function weighting 
     # which puts the minimum value at some true anomaly value and with a user defined standard deviation in this
-    prop_orb = 1. - (1. - stardata['orb_amp']) * jnp.exp(-0.5 * (((transf_nu*180./jnp.pi + 180.) - stardata['orb_min']) / val_orb_sd)**2) # weight proportion from orbital variation
-    prop_orb += 1 - jnp.heaviside(val_orb_sd - 1., 1.)
+    prop_orb = 1. - (1. - ring_params.orb_amp) * jnp.exp(-0.5 * (((transf_nu*180./jnp.pi + 180.) - ring_params.orb_min) / val_orb_sd)**2) # weight proportion from orbital variation
+    prop_orb += jnp.where(val_orb_sd < 1., 1., 0.)      # no orbital variation for tiny sd
     
     # now from azimuthal variation
     # this is analogous to the math for orbital variation, but instead of weighting entire rings based on the position in the orbit, 
     # we weight particles in the ring based on azimuthal variation in dust production
-    val_az_sd = jnp.max(jnp.array([stardata['az_sd'], 0.0001]))   # need to set a minimum azimuthal variation to avoid nans in the gradient
-    prop_az = 1. - (1. - stardata['az_amp']) * jnp.exp(-0.5 * ((shifted_theta * 180./jnp.pi - stardata['az_min']) / val_az_sd)**2)
+    val_az_sd = ring_params.az_sd   # minimum azimuthal variation already applied to avoid nans in the gradient
+    prop_az = 1. - (1. - ring_params.az_amp) * jnp.exp(-0.5 * ((shifted_theta * 180./jnp.pi - ring_params.az_min) / val_az_sd)**2)
     
     # we need our orbital weighting proportion to be between 0 and 1
-    prop_orb = jnp.min(jnp.array([prop_orb, 1.]))
-    prop_orb = jnp.max(jnp.array([prop_orb, 0.]))
+    prop_orb = jnp.clip(prop_orb, 0., 1.)
     # and the same for our azimuthal proportion
-    prop_az = prop_az.at[:].add(1 - jnp.heaviside(val_az_sd - 1., 1.))
-    prop_az = jnp.minimum(jnp.maximum(prop_az, jnp.zeros(len(prop_az))), jnp.ones(len(prop_az)))
-    weights *= prop_orb * prop_az       # now scale the particle weights by our orbital/azimuthal variations
+    prop_az = prop_az + jnp.where(val_az_sd < 1., 1., 0.)   # no azimuthal variation for tiny sd
+    prop_az = jnp.clip(prop_az, 0., 1.)
+    # fold the scalar ring weight and orbital variation together, then broadcast against
+    # the per-particle companion/azimuthal factors in one pass
+    weights = (ring_weight * prop_orb) * companion_dissociate * prop_az
     
     
     # now set up our particles in the needed array format
@@ -568,6 +656,23 @@ def dust_circle(i_nu, stardata, theta, plume_direction, widths):
     
     return circle
 
+# generate every ring in the plume at once: map over the (ring number, true anomaly) pairs,
+# the columns of the plume direction array and the per-ring widths, broadcasting the
+# parameter dict and particle angles
+dust_circle_all = vmap(dust_circle, in_axes=((0, 0), None, None, None, 1, 0))
+
+def dust_circle_map(i_nu, stardata, ring_params, theta, plume_direction, width):
+    ''' Sequential counterpart to `dust_circle_all`: generates one ring at a time with
+    `lax.map` instead of batching every ring through `vmap`. Still jit-compatible, and
+    peak memory stays constant in the number of rings (at the cost of losing the
+    inter-ring parallelism), which matters for large shell counts on small GPUs.
+    Takes the same arguments as `dust_circle_all`.
+    '''
+    def one_ring(args):
+        ring_i_nu, direction, ring_width = args
+        return dust_circle(ring_i_nu, stardata, ring_params, theta, direction, ring_width)
+    return lax.map(one_ring, (i_nu, plume_direction.T, width))
+
 def calculate_semi_major(period_s, m1, m2):
     '''
     Calculates semi-major axis of an orbit given body masses (in M_odot) and orbital period (in seconds).
@@ -600,7 +705,48 @@ def calculate_semi_major(period_s, m1, m2):
 
 
 
-def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
+def turn_anomaly_bounds(stardata, max_anom=180.):
+    ''' Converts the dust turn on/off true anomalies (padded by 2 sigma of the gradual
+    turn on/off) into the corresponding mean anomalies. These bound the window of the
+    orbit that actually produces dust, so ring generation only spends resolution there.
+    
+    Parameters
+    ----------
+    stardata : dict
+        The all-encompassing dictionary of binary/plume parameters (only the turn_on,
+        turn_off, gradual_turn and eccentricity scalars are used).
+    max_anom : float
+        Largest magnitude true anomaly (in degrees) to allow.
+    
+    Returns
+    -------
+    turn_on_mean_anom, turn_off_mean_anom : float
+        Mean anomalies of the start/end of dust production.
+    delta_M : float
+        The mean anomaly range spanned, turn_off_mean_anom - turn_on_mean_anom.
+    '''
+    ecc = stardata['eccentricity']
+    # E = 2 arctan2(sqrt(1-e) sin(nu/2), sqrt(1+e) cos(nu/2)) is equivalent to the
+    # tan-half-angle form but has no singularity at nu = +/-180 degrees, which is why
+    # max_anom no longer needs an epsilon backed off from 180. The true anomalies are
+    # kept signed in [-pi, pi] (not wrapped into [0, 2pi)) so E and M come out on the
+    # signed branch and delta_M spans the dust-producing arc through periastron
+    sqrt_ome = jnp.sqrt(1. - ecc)
+    sqrt_ope = jnp.sqrt(1. + ecc)
+    
+    ## set our 'lower' true anomaly bound to be (-180, nu_on - 2 * sigma], where the sigma is our gradual turn on (i.e. we go up to 2 sigma gradual turn on)
+    turn_on_true_anom = jnp.deg2rad(jnp.maximum(-max_anom, stardata['turn_on'] - 2. * stardata['gradual_turn']))
+    turn_on_ecc_anom = 2. * jnp.arctan2(sqrt_ome * jnp.sin(turn_on_true_anom / 2.), sqrt_ope * jnp.cos(turn_on_true_anom / 2.))
+    turn_on_mean_anom = turn_on_ecc_anom - ecc * jnp.sin(turn_on_ecc_anom)
+    
+    ## set our 'upper' true anomaly bound to be [nu_off + 2 * sigma, 180), where the sigma is our gradual turn off (i.e. we go up to 2 sigma gradual turn off)
+    turn_off_true_anom = jnp.deg2rad(jnp.minimum(max_anom, stardata['turn_off'] + 2. * stardata['gradual_turn']))
+    turn_off_ecc_anom = 2. * jnp.arctan2(sqrt_ome * jnp.sin(turn_off_true_anom / 2.), sqrt_ope * jnp.cos(turn_off_true_anom / 2.))
+    turn_off_mean_anom = turn_off_ecc_anom - ecc * jnp.sin(turn_off_ecc_anom)
+    
+    return turn_on_mean_anom, turn_off_mean_anom, turn_off_mean_anom - turn_on_mean_anom
+
+def dust_plume_sub(theta, times, n_orbits, period_s, stardata, sequential_rings=False):
     '''
     Sub-routine for the 'dust_plume' function. This function creates the particle cloud given the stellar parameters,
     number of shells, etc.
@@ -618,6 +764,9 @@ def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
         The orbital period (in units of s) of the binary.
     stardata : dict
         The all-encompassing dictionary of binary/plume parameters.
+    sequential_rings : bool
+        If True, generate the rings one at a time with `lax.map` instead of all at once
+        with `vmap` -- slower, but with peak memory constant in the number of rings.
 
     Returns
     -------
@@ -634,43 +783,9 @@ def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
     n_t = int(n_time / n_orbits)
     ecc = stardata['eccentricity']
     
-    ecc_factor = jnp.sqrt((1. - ecc) / (1. + ecc))
-    
-    max_anom = 180. - 1e-1  # we get errors when our turn on/off are at +/- 180 degrees exactly
-    
-    ## set our 'lower' true anomaly bound to be (-180, nu_on - 2 * sigma], where the sigma is our gradual turn on (i.e. we go up to 2 sigma gradual turn on)
-    turn_on_true_anom = jnp.max(jnp.array([-max_anom, stardata['turn_on'] - 2. * stardata['gradual_turn']]))
-    turn_on_true_anom = (jnp.deg2rad(turn_on_true_anom))%(2. * jnp.pi) 
-    # turn_on_ecc_anom = 2. * jnp.arctan(ecc_factor * jnp.tan(turn_on_true_anom / 2.))
-    turn_on_ecc_anom = 2. * zero_safe_arctan2(jnp.tan(turn_on_true_anom / 2.), 1./ecc_factor)
-    turn_on_mean_anom = turn_on_ecc_anom - ecc * jnp.sin(turn_on_ecc_anom)
-    
-    # turn_on_mean_anom = zero_safe_arctan2(-jnp.sqrt(1 - ecc**2) * jnp.sin(turn_on_true_anom), -ecc - jnp.cos(turn_on_true_anom)) + jnp.pi - ecc * (jnp.sqrt(1 - ecc**2) * jnp.sin(turn_on_true_anom)) / (1 + ecc * jnp.cos(turn_on_true_anom))
-    
-    # turn_off_true_anom = jnp.deg2rad(stardata['turn_off']) + jnp.pi 
-    ## set our 'upper' true anomaly bound to be [nu_off + 2 * sigma, 180), where the sigma is our gradual turn off (i.e. we go up to 2 sigma gradual turn off)
-    turn_off_true_anom = jnp.min(jnp.array([max_anom, stardata['turn_off'] + 2. * stardata['gradual_turn']]))
-    turn_off_true_anom = (jnp.deg2rad(turn_off_true_anom))%(2. * jnp.pi) 
-    # turn_off_ecc_anom = 2. * jnp.arctan(ecc_factor * jnp.tan(turn_off_true_anom / 2.))
-    turn_off_ecc_anom = 2. * zero_safe_arctan2(jnp.tan(turn_off_true_anom / 2.), 1./ecc_factor)
-    turn_off_mean_anom = turn_off_ecc_anom - ecc * jnp.sin(turn_off_ecc_anom)
-    
-    # print(turn_on_mean_anom, turn_off_mean_anom)
-    
-    # turn_off_mean_anom = zero_safe_arctan2(-jnp.sqrt(1 - ecc**2) * jnp.sin(turn_off_true_anom), -ecc - jnp.cos(turn_off_true_anom)) + jnp.pi - ecc * (jnp.sqrt(1 - ecc**2) * jnp.sin(turn_off_true_anom)) / (1 + ecc * jnp.cos(turn_off_true_anom))
-    
-    # print(turn_on_mean_anom)
-    # print(turn_off_mean_anom)
-    # mean_anomalies = jnp.linspace(turn_on_mean_anom, turn_off_mean_anom + 2 * jnp.pi, len(times))%(2 * jnp.pi)
-
-    # mean_anomalies = jnp.linspace(turn_on_mean_anom, turn_off_mean_anom, len(times))%(2 * jnp.pi)
-    
-    delta_M = turn_off_mean_anom - turn_on_mean_anom
-    mean_anomalies = ((jnp.linspace(stardata['phase'], n_orbits + stardata['phase'], len(times))%1) * delta_M + turn_on_mean_anom)%(2. * jnp.pi)
-    
+    turn_on_mean_anom, turn_off_mean_anom, delta_M = turn_anomaly_bounds(stardata)
     
     phase_radians = 2. * jnp.pi * stardata['phase']
-    # mean_anomalies = (jnp.linspace(0, delta_M, len(times)) + turn_on_mean_anom)%(2. * jnp.pi)
     mean_anomalies = (jnp.linspace(0., delta_M, n_t) + turn_on_mean_anom)%(2. * jnp.pi)
     mean_anomalies = jnp.tile(mean_anomalies, n_orbits)
     # mean_anomalies = jnp.where((phase_radians < turn_off_mean_anom) or (phase_radians > (turn_on_mean_anom%(2*jnp.pi))), 
@@ -679,8 +794,7 @@ def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
     
     # print(mean_anomalies)
     
-    E = kepler(mean_anomalies, jnp.array([ecc]))
-    true_anomaly = true_from_eccentric_anomaly(E, ecc)
+    E, true_anomaly = kepler_to_nu(mean_anomalies, jnp.array([ecc]))
     
     a1, a2 = calculate_semi_major(period_s, stardata['m1'], stardata['m2'])
     r1 = a1 * (1. - ecc * jnp.cos(E)) * 1e-3     # radius in km 
@@ -737,7 +851,15 @@ def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
     plume_direction = positions1 - positions2               # get the line of sight from first star to the second in the orbital frame
     
         
-    particles = vmap(lambda i_nu: dust_circle(i_nu, stardata, theta, plume_direction, widths))((jnp.arange(n_time), true_anomaly))
+    ring_params = ring_params_from_stardata(stardata)   # do all of the per-ring unit conversions once
+    # the orbit solution above needs the module-wide float64 (the semi-major axis
+    # intermediates overflow float32), but the ring construction is the bulk of the
+    # array work and is comfortably within float32 range, so downcast its inputs and
+    # generate the n_rings x n_points cloud at single precision
+    to_f32 = lambda tree: jax.tree_util.tree_map(lambda leaf: jnp.asarray(leaf, jnp.float32), tree)
+    ring_fn = dust_circle_map if sequential_rings else dust_circle_all
+    particles = ring_fn((jnp.arange(n_time), to_f32(true_anomaly)), to_f32(stardata),
+                        to_f32(ring_params), to_f32(theta), to_f32(plume_direction), to_f32(widths))
 
 
 
@@ -745,38 +867,46 @@ def dust_plume_sub(theta, times, n_orbits, period_s, stardata):
 
 
 
-    weights = particles[:, 3, :].flatten()
-    particles = particles[:, :3, :]
-    
-    
-    particles = jnp.array([jnp.ravel(particles[:, 0, :]),
-                           jnp.ravel(particles[:, 1, :]),
-                           jnp.ravel(particles[:, 2, :])])
+    # repack (n_time, 4, n_points) -> (4, n_time*n_points) with one transpose+reshape
+    # instead of three ravel copies and a stack
+    particles = particles.transpose(1, 0, 2).reshape(4, -1)
+    weights = particles[3]
+    particles = particles[:3]
     
 
     ### the shock originates from the second star, not the WR, so we need to add its position to the spiral
-    shock_start = positions2
-    shock_start = jnp.repeat(shock_start, len(theta), axis=-1)
-    particles += shock_start
+    # broadcast the (3, n_time) star positions against the rings instead of materializing
+    # the full jnp.repeat copy at (3, n_time*n_points)
+    particles = (particles.reshape(3, n_time, len(theta))
+                 + positions2.astype(jnp.float32)[:, :, None]).reshape(3, -1)
 
+    # the euler rotation promotes back to float64 through the (traced) orbital-element
+    # scalars, so drop back down before the final per-particle transform
     particles = euler_angles(particles, stardata['asc_node'], stardata['inclination'], stardata['arg_peri'])
+    particles = particles.astype(jnp.float32)
 
-    return 60 * 60 * 180 / jnp.pi * jnp.arctan(particles / (stardata['distance'] * 3.086e13)), weights
+    # small-angle: the plume spans arcseconds, so arctan(x) = x to well below float32
+    # precision and the km -> arcsec conversion collapses to one scalar multiply
+    arcsec_per_km = jnp.asarray(60 * 60 * 180 / jnp.pi / (stardata['distance'] * 3.086e13), jnp.float32)
+    return arcsec_per_km * particles, weights
 
-@jit
-def dust_plume(stardata):
+@partial(jit, static_argnames=('n_t', 'n_points'))
+def dust_plume(stardata, n_t=1000, n_points=500):
     '''
     Parameters
     ----------
     stardata : dict
+    n_t : int
+        Circles (rings) per orbital period. Static, so each resolution compiles once
+        with fully concrete shapes.
+    n_points : int
+        Points per circle. Static as above.
     '''
     phase = stardata['phase']%1
     
     period_s = stardata['period'] * 365.25 * 24 * 60 * 60
     
     n_orbits = 1
-    n_t = 1000       # circles per orbital period
-    n_points = 500   # points per circle
     n_particles = n_points * n_t * n_orbits
     n_time = n_t * n_orbits
     theta = 2 * jnp.pi * jnp.linspace(0, 1, n_points)
@@ -785,8 +915,7 @@ def dust_plume(stardata):
     return particles, weights
   
     
-gui_funcs = [lambda stardata, i=i: dust_plume_GUI_sub(stardata, i) for i in range(1, 20)]
-gui_funcs = [jit(gui_funcs[i]) for i in range(len(gui_funcs))]
+@partial(jit, static_argnames=('n_orb',))
 def dust_plume_GUI_sub(stardata, n_orb):
     phase = stardata['phase']%1
     
@@ -802,6 +931,71 @@ def dust_plume_GUI_sub(stardata, n_orb):
     particles, weights = dust_plume_sub(theta, times, n_orbits, period_s, stardata)
     return particles, weights
 
+# the shell count is a static argument above, so jax keeps one specialised executable
+# per n_orb actually used -- the old 19-element list of separately jitted lambdas gave
+# the same specialisation but with 19 independent caches. The list is kept as a shim so
+# existing gui_funcs[shells - 1] call sites keep working
+gui_funcs = [partial(dust_plume_GUI_sub, n_orb=i) for i in range(1, 20)]
+
+# ahead-of-time compiled plume generators, built lazily on first use. Lowering against a
+# concrete stardata pins the executable to that dict's structure and scalar dtypes, so
+# every later call skips tracing and cache lookup entirely -- useful for the GUI and
+# lightcurve loops where the same shell count is evaluated thousands of times
+_gui_funcs_compiled = {}
+
+def compile_gui_func(n_orb, stardata):
+    ''' Returns an AOT-compiled version of `dust_plume_GUI_sub` for the given shell
+    count, compiling it on the first request. The returned executable only accepts
+    stardata dicts with the same keys and scalar dtypes as the one supplied here.
+    '''
+    if n_orb not in _gui_funcs_compiled:
+        _gui_funcs_compiled[n_orb] = dust_plume_GUI_sub.lower(stardata, n_orb=n_orb).compile()
+    return _gui_funcs_compiled[n_orb]
+
+
+def gaussian_blur(H, sigma):
+    ''' Applies a Gaussian blur to a 2D image via two 1D convolutions, exploiting the
+    separability of the Gaussian kernel. This does O(K) work per pixel for a kernel of
+    width K, vs O(K^2) for the dense 2D kernel (or the FFT machinery of
+    signal.convolve), and matches the old 31x31 `method='fft'` blur to rounding error
+    since that kernel was exactly the outer product of this 1D one with itself.
+    
+    Parameters
+    ----------
+    H : jnp.array (im_size x im_size)
+        The image to blur
+    sigma : float
+        Standard deviation of the Gaussian kernel, in units of pixels. May be traced
+        (it is a fit parameter), so the kernel is built on-device rather than cached.
+    '''
+    shape = 30 // 2  # choose just large enough grid for our gaussian
+    offsets = jnp.arange(-shape, shape+1)
+    g = jnp.exp(-(offsets * offsets) / (2. * sigma**2))
+    g = (g / g.sum()).astype(H.dtype)
+    # NCHW image against a 1xK kernel, applied along each axis in turn
+    H = H[None, None, :, :]
+    H = lax.conv_general_dilated(H, g[None, None, :, None], (1, 1), 'SAME')
+    H = lax.conv_general_dilated(H, g[None, None, None, :], (1, 1), 'SAME')
+    return H[0, 0]
+
+@partial(jit, donate_argnums=(0,))
+def normalise_image(H, sigma, histmax, lum_power):
+    ''' The blur + normalise tail of the smooth histogram pipeline. H is donated, so
+    XLA can reuse its buffer through the whole chain of elementwise updates instead of
+    allocating a fresh im_size x im_size array at each step. Takes the three scalars
+    directly (not the stardata dict) so the cache keys only on what the maths uses.
+    '''
+    H = gaussian_blur(H, sigma)
+    
+    H /= jnp.max(H)     # H now peaks at exactly 1, so the clamp below bounds it to histmax
+    H = jnp.minimum(H, histmax)
+    # rescaling before the power is redundant: a positive scale factor passes straight
+    # through the (monotone) power and cancels in the final normalisation, so one max
+    # reduction at the end replaces the two the old chain re-did in between
+    H = jnp.where(lum_power == 1., H, jnp.abs(H))**lum_power
+    H /= jnp.max(H)
+    
+    return H
 
 def smooth_histogram2d_base(particles, weights, stardata, xedges, yedges, im_size):
     '''
@@ -810,15 +1004,18 @@ def smooth_histogram2d_base(particles, weights, stardata, xedges, yedges, im_siz
     y = particles[1, :]
     
     side_width = xedges[1] - xedges[0]
-    
+    inv_side_width = 1. / side_width    # the bins are uniform, so one reciprocal replaces a divide per particle
+
     xpos = x - jnp.min(xedges)
     ypos = y - jnp.min(yedges)
+
+    x_indices = jnp.floor(xpos * inv_side_width).astype(jnp.int32)
+    y_indices = jnp.floor(ypos * inv_side_width).astype(jnp.int32)
     
-    x_indices = jnp.floor(xpos / side_width).astype(int)
-    y_indices = jnp.floor(ypos / side_width).astype(int)
-    
-    alphas = xpos%side_width
-    betas = ypos%side_width
+    # reuse the bin index for the intra-bin offset: one multiply+subtract per particle
+    # instead of the modulo's divide/floor/multiply/subtract chain
+    alphas = xpos - x_indices * side_width
+    betas = ypos - y_indices * side_width
     
     a_s = jnp.minimum(alphas, side_width - alphas) + side_width / 2
     b_s = jnp.minimum(betas, side_width - betas) + side_width / 2
@@ -826,78 +1023,85 @@ def smooth_histogram2d_base(particles, weights, stardata, xedges, yedges, im_siz
     one_minus_a_indices = x_indices + jnp.where(alphas > side_width / 2, 1, -1)
     one_minus_b_indices = y_indices + jnp.where(betas > side_width / 2, 1, -1)
     
-    one_minus_a_indices = one_minus_a_indices.astype(int)
-    one_minus_b_indices = one_minus_b_indices.astype(int)
-    
-    # now check the indices that are out of bounds
-    x_edge_check = jnp.heaviside(one_minus_a_indices, 1) * jnp.heaviside(im_size - one_minus_a_indices, 0)
-    y_edge_check = jnp.heaviside(one_minus_b_indices, 1) * jnp.heaviside(im_size - one_minus_b_indices, 0)
-    x_main_check = jnp.heaviside(x_indices, 1) * jnp.heaviside(im_size - x_indices, 0)
-    y_main_check = jnp.heaviside(y_indices, 1) * jnp.heaviside(im_size - y_indices, 0)
-
-    x_edge_check = x_edge_check.astype(int)
-    x_main_check = x_main_check.astype(int)
-    y_edge_check = y_edge_check.astype(int)
-    y_main_check = y_main_check.astype(int)
+    one_minus_a_indices = one_minus_a_indices.astype(jnp.int32)
+    one_minus_b_indices = one_minus_b_indices.astype(jnp.int32)
     
-    main_quadrant = a_s * b_s * weights * x_main_check * y_main_check
-    horizontal_quadrant = (side_width - a_s) * b_s * weights * x_edge_check * y_main_check
-    vertical_quadrant = a_s * (side_width - b_s) * weights * y_edge_check * x_main_check
-    corner_quadrant = (side_width - a_s) * (side_width - b_s) * weights * x_edge_check * y_edge_check
+    main_quadrant = a_s * b_s * weights
+    horizontal_quadrant = (side_width - a_s) * b_s * weights
+    vertical_quadrant = a_s * (side_width - b_s) * weights
+    corner_quadrant = (side_width - a_s) * (side_width - b_s) * weights
 
     # The below few lines rely fundamentally on the following line sourced from https://jax.readthedocs.io/en/latest/_autosummary/jax.numpy.ndarray.at.html :
     # Unlike NumPy in-place operations such as x[idx] += y, if multiple indices refer to the same location, all updates will be applied (NumPy would only apply the last update, rather than applying all updates.)
     
+    # merge the four quadrant streams into one scatter, sorted by row-major bin id so
+    # XLA can lower the add as a segmented sum rather than four serialized atomic
+    # scatters. mode='drop' makes the scatter itself discard out-of-bounds bins, which
+    # is exactly what the old heaviside edge masks did by zeroing their weights --
+    # but .at[] normalizes negative indices NumPy-style before dropping, so negatives
+    # must first be pushed out of range or they would wrap onto the opposite edge, and
+    # indices past im_size are clamped onto the same dropped row/column so the sort key
+    # below stays in lockstep with the index tuples actually scattered
+    ix = jnp.concatenate([x_indices, one_minus_a_indices, x_indices, one_minus_a_indices])
+    iy = jnp.concatenate([y_indices, y_indices, one_minus_b_indices, one_minus_b_indices])
+    ix = jnp.where((ix < 0) | (ix > im_size), im_size, ix)
+    iy = jnp.where((iy < 0) | (iy > im_size), im_size, iy)
+    flat_values = jnp.concatenate([main_quadrant, horizontal_quadrant,
+                                   vertical_quadrant, corner_quadrant])
+    # stride im_size + 1 keeps the key unique now that clamped indices can equal im_size
+    order = jnp.argsort(ix * (im_size + 1) + iy)
     H = jnp.zeros((im_size, im_size))
-    H = H.at[x_indices, y_indices].add(main_quadrant)
-    H = H.at[one_minus_a_indices, y_indices].add(horizontal_quadrant)
-    H = H.at[x_indices, one_minus_b_indices].add(vertical_quadrant)
-    H = H.at[one_minus_a_indices, one_minus_b_indices].add(corner_quadrant)
+    H = H.at[ix[order], iy[order]].add(flat_values[order], mode='drop',
+                                       indices_are_sorted=True, unique_indices=False)
 
     X, Y = jnp.meshgrid(xedges, yedges)
-    H = H.T
-    
-    shape = 30 // 2  # choose just large enough grid for our gaussian
-    gx, gy = jnp.meshgrid(jnp.arange(-shape, shape+1, 1), jnp.arange(-shape, shape+1, 1))
-    gxy = jnp.exp(- (gx*gx + gy*gy) / (2 * stardata['sigma']**2))
-    gxy /= gxy.sum()
-    
-    H = signal.convolve(H, gxy, mode='same', method='fft')
-    
-    H /= jnp.max(H)
-    
-    
-    H = jnp.minimum(H, jnp.ones((im_size, im_size)) * stardata['histmax'])
-    H /= jnp.max(H)
-    
-    H = jnp.where(stardata['lum_power'] == 1., H, jnp.abs(H))
-    H = H**stardata['lum_power']
-    H /= jnp.max(H)
+    H = normalise_image(H.T, stardata['sigma'], stardata['histmax'], stardata['lum_power'])
     
     return X, Y, H
 n = 256
-@jit
-def smooth_histogram2d(particles, weights, stardata):
-    im_size = n
+@partial(jit, static_argnames=('im_size',))
+def smooth_histogram2d(particles, weights, stardata, im_size=n):
     
     x = particles[0, :]
     y = particles[1, :]
     
-    xbound, ybound = jnp.max(jnp.abs(x)), jnp.max(jnp.abs(y))
-    bound = jnp.max(jnp.array([xbound, ybound])) * (1. + 2. / im_size)
+    # max(|x|) as two fused reductions, skipping the N-particle jnp.abs temporary
+    xbound = jnp.maximum(jnp.max(x), -jnp.min(x))
+    ybound = jnp.maximum(jnp.max(y), -jnp.min(y))
+    bound = jnp.maximum(xbound, ybound) * (1. + 2. / im_size)
     
     xedges, yedges = jnp.linspace(-bound, bound, im_size+1), jnp.linspace(-bound, bound, im_size+1)
     return smooth_histogram2d_base(particles, weights, stardata, xedges, yedges, im_size)
-@jit
-def smooth_histogram2d_w_bins(particles, weights, stardata, xbins, ybins):
-    im_size = n
+@partial(jit, static_argnames=('im_size',))
+def smooth_histogram2d_w_bins(particles, weights, stardata, xbins, ybins, im_size=n):
     return smooth_histogram2d_base(particles, weights, stardata, xbins, ybins, im_size)
 
 
 
 
-@jit
-def spiral_grid(particles, weights, stardata):
+def uniform_histogram2d(x, y, weights, xedges, yedges, im_size):
+    ''' Weighted 2D histogram over uniformly spaced bin edges. With uniform bins the
+    bin index is one subtract+multiply+floor per particle feeding a single O(N)
+    scatter-add, where jnp.histogram2d lowers to sort-based binning per axis (O(N log N)
+    plus several N-sized temporaries). Matches histogram2d's convention of including
+    the right-most edge in the last bin; out-of-range particles are dropped by the
+    scatter itself.
+    '''
+    inv_dx = 1. / (xedges[1] - xedges[0])
+    inv_dy = 1. / (yedges[1] - yedges[0])
+    ix = jnp.floor((x - xedges[0]) * inv_dx).astype(jnp.int32)
+    iy = jnp.floor((y - yedges[0]) * inv_dy).astype(jnp.int32)
+    ix = jnp.where(x == xedges[-1], im_size - 1, ix)
+    iy = jnp.where(y == yedges[-1], im_size - 1, iy)
+    # .at[] normalizes negative indices before dropping, so push particles left of the
+    # grid out of range rather than letting them wrap onto the far edge
+    ix = jnp.where(ix < 0, im_size, ix)
+    iy = jnp.where(iy < 0, im_size, iy)
+    H = jnp.zeros((im_size, im_size))
+    return H.at[ix, iy].add(weights, mode='drop')
+
+@partial(jit, static_argnames=('im_size',))
+def spiral_grid(particles, weights, stardata, im_size=256):
     ''' Takes in the particle positions and weights and calculates the 2D histogram, ignoring those points at (0,0,0), and
         applying a Gaussian blur.
     Parameters
@@ -908,33 +1112,29 @@ def spiral_grid(particles, weights, stardata):
         Weight of each particle in the histogram (for orbital/azimuthal variations)
     sigma : 
     '''
-    im_size = 256
     
     x = particles[0, :]
     y = particles[1, :]
     
     weights = jnp.where((x != 0) & (y != 0), weights, 0)
     
-    H, xedges, yedges = jnp.histogram2d(x, y, bins=im_size, weights=weights)
+    xedges = jnp.linspace(jnp.min(x), jnp.max(x), im_size + 1)
+    yedges = jnp.linspace(jnp.min(y), jnp.max(y), im_size + 1)
+    H = uniform_histogram2d(x, y, weights, xedges, yedges, im_size)
     X, Y = jnp.meshgrid(xedges, yedges)
     H = H.T
     H /= jnp.max(H)
     
     H = jnp.minimum(H, jnp.ones((im_size, im_size)) * stardata['histmax'])
     
-    shape = 30 // 2  # choose just large enough grid for our gaussian
-    gx, gy = jnp.meshgrid(jnp.arange(-shape, shape+1, 1), jnp.arange(-shape, shape+1, 1))
-    gxy = jnp.exp(- (gx*gx + gy*gy) / (2 * stardata['sigma']**2))
-    gxy /= gxy.sum()
-    
-    H = signal.convolve(H, gxy, mode='same', method='fft')
+    H = gaussian_blur(H, stardata['sigma'])
     
     H /= jnp.max(H)
     H = H**stardata['lum_power']
     
     return X, Y, H
-@jit
-def spiral_grid_w_bins(particles, weights, stardata, xbins, ybins):
+@partial(jit, static_argnames=('im_size',))
+def spiral_grid_w_bins(particles, weights, stardata, xbins, ybins, im_size=256):
     ''' Takes in the particle positions and weights and calculates the 2D histogram, ignoring those points at (0,0,0), and
         applying a Gaussian blur.
     Parameters
@@ -945,26 +1145,20 @@ def spiral_grid_w_bins(particles, weights, stardata, xbins, ybins):
         Weight of each particle in the histogram (for orbital/azimuthal variations)
     sigma : 
     '''
-    im_size = 256
     
     x = particles[0, :]
     y = particles[1, :]
     
     weights = jnp.where((x != 0) & (y != 0), weights, 0)
     
-    H, xedges, yedges = jnp.histogram2d(x, y, bins=[xbins, ybins], weights=weights)
-    X, Y = jnp.meshgrid(xedges, yedges)
+    H = uniform_histogram2d(x, y, weights, xbins, ybins, im_size)
+    X, Y = jnp.meshgrid(xbins, ybins)
     H = H.T
     H /= jnp.max(H)
     
     H = jnp.minimum(H, jnp.ones((im_size, im_size)) * stardata['histmax'])
     
-    shape = 30 // 2  # choose just large enough grid for our gaussian
-    gx, gy = jnp.meshgrid(jnp.arange(-shape, shape+1, 1), jnp.arange(-shape, shape+1, 1))
-    gxy = jnp.exp(- (gx*gx + gy*gy) / (2 * stardata['sigma']**2))
-    gxy /= gxy.sum()
-    
-    H = signal.convolve(H, gxy, mode='same', method='fft')
+    H = gaussian_blur(H, stardata['sigma'])
     
     H /= jnp.max(H)
     H = H**stardata['lum_power']
@@ -1004,10 +1198,18 @@ def spiral_gif(stardata):
     ax.set(xlim=(xmin, xmax), ylim=(ymin, ymax), aspect='equal', 
            xlabel='Relative RA (")', ylabel='Relative Dec (")')
     
+    # fix the histogram grid to the displayed window, so the QuadMesh coordinates stay
+    # valid for every frame and only its colour array needs rewriting
+    xbins = jnp.linspace(xmin, xmax, 257)
+    ybins = jnp.linspace(ymin, ymax, 257)
+    
     starcopy['phase'] = 0.5
     particles, weights = dust_plume(starcopy)
-    X, Y, H = spiral_grid(particles, weights, starcopy)
+    X, Y, H = spiral_grid_w_bins(particles, weights, starcopy, xbins, ybins)
     # vmin, vmax = jnp.min(H), jnp.max(H)
+    # draw the mesh once -- each frame mutates it in place instead of allocating a fresh
+    # QuadMesh (and its buffers) per frame
+    mesh = ax.pcolormesh(X, Y, H, cmap='hot')
     
     every = 1
     length = 10
@@ -1026,10 +1228,8 @@ def spiral_gif(stardata):
         # print(i)
         starcopy['phase'] = phases[i] + 0.5
         particles, weights = dust_plume(starcopy)
-        X, Y, H = spiral_grid(particles, weights, starcopy)
-        # ax.imshow(H, extent=[0, 1, 0, 1], vmin=vmin, vmax=vmax, cmap='Greys')
-        # ax.pcolormesh(xedges, yedges[::-1], H, vmax=vmax)
-        ax.pcolormesh(X, Y, H, cmap='hot')
+        X, Y, H = spiral_grid_w_bins(particles, weights, starcopy, xbins, ybins)
+        mesh.set_array(np.asarray(H).ravel())
         return fig, 
 
     ani = animation.FuncAnimation(fig, animate, frames=frames, blit=True, repeat=False)
@@ -1067,8 +1267,7 @@ def orbital_position(stardata):
     ecc = stardata['eccentricity']
     # E, true_anomaly = kepler_solve(times, period_s, ecc)
     
-    E = kepler(2 * jnp.pi * time / period_s, jnp.array([ecc]))
-    true_anomaly = true_from_eccentric_anomaly(E, ecc)
+    E, true_anomaly = kepler_to_nu(2 * jnp.pi * time / period_s, jnp.array([ecc]))
     
     a1, a2 = calculate_semi_major(period_s, stardata['m1'], stardata['m2'])
     r1 = a1 * (1 - ecc * jnp.cos(E)) * 1e-3     # radius in km 
@@ -1163,8 +1362,7 @@ def orbital_positions(stardata):
     ecc = stardata['eccentricity']
     # E, true_anomaly = kepler_solve(times, period_s, ecc)
     
-    E = kepler(2 * jnp.pi * times / period_s, jnp.array([ecc]))
-    true_anomaly = true_from_eccentric_anomaly(E, ecc)
+    E, true_anomaly = kepler_to_nu(2 * jnp.pi * times / period_s, jnp.array([ecc]))
     
     a1, a2 = calculate_semi_major(period_s, stardata['m1'], stardata['m2'])
     r1 = a1 * (1 - ecc * jnp.cos(E)) * 1e-3     # radius in km 
@@ -1183,8 +1381,9 @@ def orbital_positions(stardata):
 def transform_orbits(pos1, pos2, stardata):
     pos1 = euler_angles(pos1, stardata['asc_node'], stardata['inclination'], stardata['arg_peri'])
     pos2 = euler_angles(pos2, stardata['asc_node'], stardata['inclination'], stardata['arg_peri'])
-    pos1 = 60 * 60 * 180 / jnp.pi * jnp.arctan(pos1 / (stardata['distance'] * 3.086e13))
-    pos2 = 60 * 60 * 180 / jnp.pi * jnp.arctan(pos2 / (stardata['distance'] * 3.086e13))
+    arcsec_per_km = 60 * 60 * 180 / jnp.pi / (stardata['distance'] * 3.086e13)
+    pos1 = arcsec_per_km * pos1
+    pos2 = arcsec_per_km * pos2
     return pos1, pos2
 
 # @jit
@@ -1233,10 +1432,25 @@ def orbit_spiral_gif(stardata):
     ybins = np.linspace(-lim, lim, 257)
     ax.set_aspect('equal')
     
+    # create every artist once and mutate them per frame, rather than clearing the axes
+    # and re-creating a QuadMesh + lines + scatter + text on each iteration
+    starcopy['phase'] = phases[0] + 0.5
+    particles, weights = dust_plume_for_gif(starcopy)
+    pos1, pos2 = orbital_positions(starcopy)
+    pos1, pos2 = transform_orbits(pos1, pos2, starcopy)
+    X, Y, H = spiral_grid_w_bins(particles, weights, starcopy, xbins, ybins)
+    mesh = ax.pcolormesh(X, Y, H, cmap='hot')
+    line1, = ax.plot(pos1[0, :], pos1[1, :], c='w')
+    line2, = ax.plot(pos2[0, :], pos2[1, :], c='w')
+    star_dots = ax.scatter([pos1[0, -1], pos2[0, -1]], [pos1[1, -1], pos2[1, -1]], c=['tab:cyan', 'w'], s=100)
+    phase_text = ax.text(0.3 * lim, -0.8 * lim, f"Phase = {starcopy['phase']%1:.2f}", c='w', fontsize=14)
+    ax.set(xlim=(-lim, lim), ylim=(-lim, lim))
+    ax.set_facecolor('k')
+    ax.set_axis_off()
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
     
     # @jit
     def animate(i):
-        ax.cla()
         if i%20 == 0:
             print(i)
         starcopy['phase'] = phases[i] + 0.5
@@ -1246,18 +1460,12 @@ def orbit_spiral_gif(stardata):
         pos1, pos2 = transform_orbits(pos1, pos2, starcopy)
 
         X, Y, H = spiral_grid_w_bins(particles, weights, starcopy, xbins, ybins)
-        ax.pcolormesh(X, Y, H, cmap='hot')
-        
-        
-        ax.plot(pos1[0, :], pos1[1, :], c='w')
-        ax.plot(pos2[0, :], pos2[1, :], c='w')
-        ax.scatter([pos1[0, -1], pos2[0, -1]], [pos1[1, -1], pos2[1, -1]], c=['tab:cyan', 'w'], s=100)
-        
-        ax.set(xlim=(-lim, lim), ylim=(-lim, lim))
-        ax.set_facecolor('k')
-        ax.set_axis_off()
-        ax.text(0.3 * lim, -0.8 * lim, f"Phase = {starcopy['phase']%1:.2f}", c='w', fontsize=14)
-        fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
+        mesh.set_array(np.asarray(H).ravel())
+        line1.set_data(pos1[0, :], pos1[1, :])
+        line2.set_data(pos2[0, :], pos2[1, :])
+        star_dots.set_offsets(np.column_stack([[pos1[0, -1], pos2[0, -1]],
+                                               [pos1[1, -1], pos2[1, -1]]]))
+        phase_text.set_text(f"Phase = {starcopy['phase']%1:.2f}")
         return fig, 
 
     ani = animation.FuncAnimation(fig, animate, frames=frames, blit=True, repeat=False)
@@ -1266,125 +1474,99 @@ def orbit_spiral_gif(stardata):
 
 def generate_lightcurve(stardata, n=100, shells=1):
     phases = jnp.linspace(0, 1, n)
-    fluxes = np.zeros(n)
     
     # im_size = 256
     im_size = 600
     
-    for i in range(n):
+    def flux_at_phase(phase):
         starcopy = stardata.copy()
-        starcopy['phase'] = phases[i]
+        starcopy['phase'] = phase
         
-        particles, weights = gui_funcs[shells - 1](starcopy)
+        particles, weights = dust_plume_GUI_sub(starcopy, n_orb=shells)
         
         x = particles[0, :]
         y = particles[1, :]
         
-        H, xedges, yedges = jnp.histogram2d(x, y, bins=im_size, weights=weights)
-        X, Y = jnp.meshgrid(xedges, yedges)
-        
-        # xbound, ybound = jnp.max(jnp.abs(x)), jnp.max(jnp.abs(y))
-        # bound = jnp.max(jnp.array([xbound, ybound])) * (1. + 2. / im_size)
-        
-        # xedges, yedges = jnp.linspace(-bound, bound, im_size+1), jnp.linspace(-bound, bound, im_size+1)
-        # X, Y, H = smooth_histogram2d_base(particles, weights, starcopy, xedges, yedges, im_size)
-        # H = H.T
-        
-        
+        xedges = jnp.linspace(jnp.min(x), jnp.max(x), im_size + 1)
+        yedges = jnp.linspace(jnp.min(y), jnp.max(y), im_size + 1)
+        H = uniform_histogram2d(x, y, weights, xedges, yedges, im_size)
         
         H = jnp.minimum(H, jnp.ones((im_size, im_size)) * stardata['histmax'] * jnp.max(H))
         
-        shape = 30 // 2  # choose just large enough grid for our gaussian
-        gx, gy = jnp.meshgrid(jnp.arange(-shape, shape+1, 1), jnp.arange(-shape, shape+1, 1))
-        gxy = jnp.exp(- (gx*gx + gy*gy) / (2 * stardata['sigma']**2))
-        gxy /= gxy.sum()
+        H = gaussian_blur(H, stardata['sigma'])
         
-        H = signal.convolve(H, gxy, mode='same', method='fft')
-        
-        # H = add_stars(X[0, :], Y[:, 0], H, starcopy)
-        
-        # fluxes[i] = jnp.max(H)
-        # fluxes[i] = np.percentile(H, 50)
-        
-        flat_fluxes = H.flatten()
-        # # fluxes[i] = np.sum(np.sort(flat_fluxes)[-len(flat_fluxes)//100:])
-        fluxes[i] = np.mean(np.sort(flat_fluxes)[-50:])
+        # the flux proxy is the mean of the 50 brightest pixels
+        return jnp.mean(lax.top_k(H.flatten(), 50)[0])
+    
+    # map sequentially rather than vmap-ing: each phase holds a 600x600 image (plus its
+    # FFT workspace) live, and one traced graph still removes the per-phase Python and
+    # dispatch overhead of the old loop
+    fluxes = lax.map(flux_at_phase, phases)
     
     return phases, fluxes
 
 def ring_velocities(stardata, n_orb, n_rings):
     ecc = stardata['eccentricity']
-    ecc_factor = jnp.sqrt((1. - ecc) / (1. + ecc))
-    
-    max_anom = 180. - 1e-4  # we get errors when our turn on/off are at +/- 180 degrees exactly
-    
-    ## set our 'lower' true anomaly bound to be (-180, nu_on - 2 * sigma], where the sigma is our gradual turn on (i.e. we go up to 2 sigma gradual turn on)
-    turn_on_true_anom = jnp.max(jnp.array([-max_anom, stardata['turn_on'] - 2. * stardata['gradual_turn']]))
-    turn_on_true_anom = (jnp.deg2rad(turn_on_true_anom))%(2. * jnp.pi) 
-    turn_on_ecc_anom = 2. * zero_safe_arctan2(jnp.tan(turn_on_true_anom / 2.), 1./ecc_factor)
-    turn_on_mean_anom = turn_on_ecc_anom - ecc * jnp.sin(turn_on_ecc_anom)
-    
-    ## set our 'upper' true anomaly bound to be [nu_off + 2 * sigma, 180), where the sigma is our gradual turn off (i.e. we go up to 2 sigma gradual turn off)
-    turn_off_true_anom = jnp.min(jnp.array([max_anom, stardata['turn_off'] + 2. * stardata['gradual_turn']]))
-    turn_off_true_anom = (jnp.deg2rad(turn_off_true_anom))%(2. * jnp.pi) 
-    turn_off_ecc_anom = 2. * zero_safe_arctan2(jnp.tan(turn_off_true_anom / 2.), 1./ecc_factor)
-    turn_off_mean_anom = turn_off_ecc_anom - ecc * jnp.sin(turn_off_ecc_anom)
-    
-    delta_M = turn_off_mean_anom - turn_on_mean_anom
-    mean_anomalies = ((jnp.linspace(stardata['phase'], n_orb + stardata['phase'], n_rings*n_orb)%1) * delta_M + turn_on_mean_anom)%(2. * jnp.pi)
-    
-
+    turn_on_mean_anom, turn_off_mean_anom, delta_M = turn_anomaly_bounds(stardata)
     mean_anomalies = (jnp.linspace(0, delta_M, n_rings) + turn_on_mean_anom)%(2. * jnp.pi)
     mean_anomalies = jnp.tile(mean_anomalies, n_orb)
-    E = kepler(mean_anomalies, jnp.array([ecc]))
-    true_anomaly = true_from_eccentric_anomaly(E, ecc)
+    E, true_anomaly = kepler_to_nu(mean_anomalies, jnp.array([ecc]))
     
-    temp = np.array([(spin_orbit_mult(true_anomaly[i], [1], stardata)) for i in range(len(true_anomaly))])
-    oa_mult = temp[:, 0]
-    v_mult = temp[:, 1]
+    # batch over the anomalies in one traced call instead of a Python loop that
+    # dispatched (and synced) once per ring
+    oa_mult, v_mult = vmap(spin_orbit_mult, in_axes=(0, None, None))(true_anomaly, jnp.array([1.]), stardata)
     return oa_mult, v_mult
 
-def plume_velocity_map(particles, weights, stardata, velocity='LOS'):
+@partial(jit, static_argnames=('los',))
+def _plume_velocity_map_core(particles, windspeed1, los=True):
     '''TODO: will need to update the `particle_speeds` line to actually calculate the speed of each particle once anisotropy is included
+    '''
+    # the map is for plotting, so single precision is plenty; the cast is a no-op for
+    # dust_plume output (already float32) and halves bandwidth for float64 callers,
+    # and the scalar cast stops the speeds promoting back up through windspeed1
+    particles = particles.astype(jnp.float32)
+    windspeed1 = jnp.asarray(windspeed1, jnp.float32)
+    
+    # shared-subexpression form: one pass over the coordinates instead of two
+    # jnp.linalg.norm reductions over the (3, N) array
+    x, y, z = particles[0, :], particles[1, :], particles[2, :]
+    r2_xy = x * x + y * y
+    radii = jnp.sqrt(r2_xy + z * z)
+    # radii /= max(radii)
+    plane_dist = jnp.sqrt(r2_xy)
+    radial_dist = z
+    
+    if los:
+        # negative sign (folded into the scalar) so that negative radial velocity means toward us
+        signed_windspeed = -windspeed1
+        coord = radial_dist
+    else:
+        signed_windspeed = windspeed1
+        coord = plane_dist
+    
+    inv_r = lax.reciprocal(radii)
+    particle_speeds = signed_windspeed * (coord * inv_r)
+    
+    return particle_speeds
+
+def plume_velocity_map(particles, weights, stardata, velocity='LOS'):
+    '''
     Parameters
     ----------
     velocity : str
         One of {"LOS", "POS"} which indicates velocity map for particle velocity along the line of sight (radial) or
         in the plane of the sky (tangential)
     '''
-    n_t = 1000       # circles per orbital period
-    n_points = 400   # points per circle
-    
-    n_orb = len(particles[0, :]) // (n_t * n_points)
-    
-    X, Y, H = smooth_histogram2d(particles, weights, stardata)
-    xbins = X[0, :]
-    ybins = Y[:, 0]
-    
-    
-    radii = jnp.linalg.norm(particles, axis=0)
-    # radii /= max(radii)
-    plane_dist = jnp.linalg.norm(particles[:2, :], axis=0)
-    radial_dist = particles[2, :]
-    
     if velocity == "LOS":
-        velocity_mult = -radial_dist # negative sign to ensure that negative radial velocity means toward us
         cmap = 'bwr'
         cbar_label = r'Radial Velocity (km\,s$^{-1}$)'
     elif velocity == "POS":
-        velocity_mult = plane_dist
         cmap = 'Greys'
         cbar_label = r'Recoverable Velocity in POS (km\,s$^{-1}$)'
-    # plane_radii /= max(plane_radii)
     
     fig_args = {'cmap':cmap, 'cbar_label':cbar_label}
     
-    # _, anisotropy_speeds = ring_velocities(stardata, n_orb, n_t)
-    # anisotropy_speeds = np.repeat(anisotropy_speeds, n_points)
-    
-    anisotropy_speeds = 1
-    
-    particle_speeds = anisotropy_speeds * stardata['windspeed1'] * velocity_mult / radii
+    particle_speeds = _plume_velocity_map_core(particles, stardata['windspeed1'], los=(velocity == "LOS"))
     
     # fig, ax = plt.subplots()
     # n = 10
@@ -1395,6 +1577,12 @@ def plume_velocity_map(particles, weights, stardata, velocity='LOS'):
     
     return particle_speeds, fig_args
 
+# pre-specialised entry points: each binds the LOS/POS choice once, so callers that
+# know which map they want never touch the string comparison or risk mixing up the
+# flag between the speeds and the colour map
+plume_velocity_map_los = partial(plume_velocity_map, velocity='LOS')
+plume_velocity_map_pos = partial(plume_velocity_map, velocity='POS')
+
     
 
 # print(ring_velocities(wrb.apep_aniso.copy(), 1, 400))